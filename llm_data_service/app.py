@@ -6,6 +6,12 @@ import anthropic # Import the Anthropic SDK
 import re # Import the re module for regular expressions
 import urllib.parse # For URL decoding PDF paths
 import pdfplumber # For PDF text extraction
+import json # For serializing conversation state
+import csv # For catching CSV parse errors from the ingest endpoint
+import threading # For guarding the in-memory conversation store
+import time # For conversation TTLs
+import uuid # For generating conversation ids
+from ingest import ingest_csv_stream # Bulk CSV upsert into the shipments table
 
 load_dotenv() # Load environment variables from .env, including ANTHROPIC_API_KEY
 
@@ -14,6 +20,34 @@ app = Flask(__name__)
 # Determine project root (one level up from llm_data_service directory)
 PROJECT_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
 DATABASE_PATH = os.path.join(PROJECT_ROOT, 'shipping_data.db') # Adjusted to use PROJECT_ROOT
+PDF_BASE_DIR = os.path.join(PROJECT_ROOT, 'pdf')
+# On-disk cache shared by all worker processes (extracted PDF text survives restarts and reloads)
+CACHE_DB_PATH = os.getenv("LLM_SERVICE_CACHE_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), 'service_cache.db'))
+
+# In-process schema cache: {table_name: (db_mtime, schema_str)}. Filled pre-fork by warm_caches() when preloaded.
+_schema_cache = {}
+
+# Server-side conversation state, keyed by conversation id. "memory" is per-process;
+# "sqlite" stores state in CACHE_DB_PATH so it is shared by all worker processes.
+CONVERSATION_STORE_BACKEND = os.getenv("LLM_SERVICE_CONVERSATION_STORE", "memory").lower()
+CONVERSATION_TTL_SECONDS = int(os.getenv("LLM_SERVICE_CONVERSATION_TTL", "3600"))
+CONVERSATION_MAX_MESSAGES = 20 # Only the most recent messages are kept and sent to the LLM
+_conversations = {} # {conversation_id: state_dict}, used by the "memory" backend
+_conversations_lock = threading.Lock()
+
+# Assistant turns that server.js /api/llm-query filters out of chat_history before calling this service.
+# Stored history drops the same turns, so clients sending only conversation_id give the LLM the same context.
+HISTORY_EXCLUDED_ASSISTANT_PREFIXES = [
+    "Query executed successfully. Returning data.",
+    "Extracted text from PDF to answer question",
+    "Could not generate a valid SQL query for your question. LLM said: # Cannot generate SQL"
+]
+
+# answer_question_from_text_with_llm reports failures as answers starting with these, rather than raising
+PDF_ANSWER_ERROR_PREFIXES = ("Error:", "Error processing document content")
+
+# Short replies that ask for more detail about the document discussed in the previous turn
+PDF_FOLLOW_UP_PHRASES = ["yes", "ok", "sure", "tell me more", "what are the values?", "give me the percentages", "i would like to know the values"]
 
 PDF_PATH_OVERRIDES = {
     "LC VIETNAM 74 Phuc Hung Colorful Metal Joint Stock Company/ELC2500000046/ EXP. 15/4/2025": {
@@ -50,8 +84,80 @@ def sanitize_folder_name(name):
     # For now, only / -> _ is implemented based on current need.
     return sanitized
 
-def util_extract_text_from_pdf(db_column_value, shipment_name_from_db, doc_column_name):
-    """Constructs the PDF path using overrides and extracts text.
+def init_cache_db():
+    """Creates the shared cache database schema and switches it to WAL mode.
+       Runs once at import (in the gunicorn master before forking when preloaded); WAL mode is
+       persistent in the file and lets several worker processes read while one of them writes.
+    """
+    conn = sqlite3.connect(CACHE_DB_PATH, timeout=30)
+    conn.execute("PRAGMA journal_mode=WAL;")
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS pdf_text_cache ("
+        "pdf_path TEXT PRIMARY KEY, mtime REAL NOT NULL, size INTEGER NOT NULL, text TEXT NOT NULL)"
+    )
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS conversations ("
+        "conversation_id TEXT PRIMARY KEY, state TEXT NOT NULL, updated_at REAL NOT NULL)"
+    )
+    conn.commit()
+    conn.close()
+
+def get_cache_connection():
+    """Opens the shared on-disk cache database (schema is created once by init_cache_db)."""
+    return sqlite3.connect(CACHE_DB_PATH, timeout=30)
+
+try:
+    init_cache_db()
+except Exception as e:
+    app.logger.error(f"Error initializing cache database at {CACHE_DB_PATH}: {e}")
+
+def util_get_cached_pdf_text(absolute_pdf_path):
+    """Returns cached text for a PDF if the file is unchanged since it was extracted, else None."""
+    try:
+        stat = os.stat(absolute_pdf_path)
+        conn = get_cache_connection()
+        row = conn.execute(
+            "SELECT text FROM pdf_text_cache WHERE pdf_path = ? AND mtime = ? AND size = ?",
+            (absolute_pdf_path, stat.st_mtime, stat.st_size)
+        ).fetchone()
+        conn.close()
+        return row[0] if row else None
+    except Exception as e:
+        app.logger.warning(f"PDF text cache lookup failed for '{absolute_pdf_path}': {e}")
+        return None
+
+def util_store_cached_pdf_text(absolute_pdf_path, text):
+    """Stores extracted PDF text in the shared cache, keyed by path, mtime and size."""
+    try:
+        stat = os.stat(absolute_pdf_path)
+        conn = get_cache_connection()
+        with conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO pdf_text_cache (pdf_path, mtime, size, text) VALUES (?, ?, ?, ?)",
+                (absolute_pdf_path, stat.st_mtime, stat.st_size, text)
+            )
+        conn.close()
+    except Exception as e:
+        app.logger.warning(f"Could not store PDF text in cache for '{absolute_pdf_path}': {e}")
+
+def util_read_pdf_text(absolute_pdf_path):
+    """Returns the text of a PDF, using the shared cache and falling back to pdfplumber extraction."""
+    cached_text = util_get_cached_pdf_text(absolute_pdf_path)
+    if cached_text is not None:
+        app.logger.info(f"PDF text cache hit: {absolute_pdf_path}")
+        return cached_text
+
+    text = ""
+    with pdfplumber.open(absolute_pdf_path) as pdf:
+        for page in pdf.pages:
+            page_text = page.extract_text()
+            if page_text:
+                text += page_text + "\n"
+    util_store_cached_pdf_text(absolute_pdf_path, text)
+    return text
+
+def util_resolve_pdf_path(db_column_value, shipment_name_from_db, doc_column_name):
+    """Constructs the absolute PDF path using overrides. Returns None if the file cannot be found.
     Args:
         db_column_value (str): The raw value from the DB document column (e.g., a filename or partial path).
         shipment_name_from_db (str): The shipmentName from the DB.
@@ -84,7 +190,7 @@ def util_extract_text_from_pdf(db_column_value, shipment_name_from_db, doc_colum
              return None
         
         shipment_folder_name_sanitized = sanitize_folder_name(shipment_name_from_db)
-        pdf_base_dir = os.path.join(PROJECT_ROOT, 'pdf')
+        pdf_base_dir = PDF_BASE_DIR
         
         # List of filenames to try to handle space/underscore inconsistencies
         filenames_to_try = [
@@ -112,18 +218,86 @@ def util_extract_text_from_pdf(db_column_value, shipment_name_from_db, doc_colum
             # Fallback logging from before is removed as this is more comprehensive
             return None
 
-        text = ""
-        with pdfplumber.open(absolute_pdf_path) as pdf:
-            for page in pdf.pages:
-                page_text = page.extract_text()
-                if page_text:
-                    text += page_text + "\n"
+        return absolute_pdf_path
+    except Exception as e:
+        app.logger.error(f"Error resolving PDF path. Shipment: '{shipment_name_from_db}', DB Value: '{db_column_value}', Column: '{doc_column_name}'. Error: {e}")
+        return None
+
+def util_extract_text_from_pdf(absolute_pdf_path):
+    """Extracts text from a resolved PDF path (served from the shared cache when possible)."""
+    try:
+        text = util_read_pdf_text(absolute_pdf_path)
         app.logger.info(f"Extracted text from PDF (first 200 chars): {text[:200]}...")
         return text
     except Exception as e:
-        app.logger.error(f"Error extracting text from PDF. Shipment: '{shipment_name_from_db}', DB Value: '{db_column_value}', Column: '{doc_column_name}'. Error: {e}")
+        app.logger.error(f"Error extracting text from PDF '{absolute_pdf_path}': {e}")
         return None
 
+def util_new_conversation_state():
+    return {"chat_history": [], "last_sql": None, "last_document": None, "updated_at": time.time()}
+
+def util_load_conversation(conversation_id):
+    """Returns the stored state for a conversation, or a fresh state if it is unknown or expired."""
+    now = time.time()
+    if CONVERSATION_STORE_BACKEND == "sqlite":
+        try:
+            conn = get_cache_connection()
+            row = conn.execute(
+                "SELECT state FROM conversations WHERE conversation_id = ? AND updated_at > ?",
+                (conversation_id, now - CONVERSATION_TTL_SECONDS)
+            ).fetchone()
+            conn.close()
+            return json.loads(row[0]) if row else util_new_conversation_state()
+        except Exception as e:
+            app.logger.warning(f"Could not load conversation '{conversation_id}': {e}")
+            return util_new_conversation_state()
+
+    with _conversations_lock:
+        state = _conversations.get(conversation_id)
+        if not state or now - state["updated_at"] > CONVERSATION_TTL_SECONDS:
+            return util_new_conversation_state()
+        return json.loads(json.dumps(state)) # Copy, so the request can't mutate the stored state
+
+def util_save_conversation(conversation_id, state):
+    """Persists conversation state and drops conversations that have outlived the TTL."""
+    now = time.time()
+    state["updated_at"] = now
+    chat_history = state["chat_history"][-CONVERSATION_MAX_MESSAGES:]
+    # Turns without a stored answer make the length odd, so the cut can land on an answer whose question was dropped
+    while chat_history and chat_history[0].get("role") != "user":
+        chat_history = chat_history[1:]
+    state["chat_history"] = chat_history
+    if CONVERSATION_STORE_BACKEND == "sqlite":
+        try:
+            conn = get_cache_connection()
+            with conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO conversations (conversation_id, state, updated_at) VALUES (?, ?, ?)",
+                    (conversation_id, json.dumps(state), now)
+                )
+                conn.execute("DELETE FROM conversations WHERE updated_at <= ?", (now - CONVERSATION_TTL_SECONDS,))
+            conn.close()
+        except Exception as e:
+            app.logger.warning(f"Could not save conversation '{conversation_id}': {e}")
+        return
+
+    with _conversations_lock:
+        _conversations[conversation_id] = state
+        expired_ids = [cid for cid, s in _conversations.items() if now - s["updated_at"] > CONVERSATION_TTL_SECONDS]
+        for cid in expired_ids:
+            del _conversations[cid]
+
+def util_get_followup_document(conversation_state, question):
+    """Returns the document resolved in the previous turn if the question is a short PDF follow-up, else None."""
+    if not conversation_state or question.strip().lower() not in PDF_FOLLOW_UP_PHRASES:
+        return None
+    last_document = conversation_state.get("last_document")
+    if not last_document or not conversation_state.get("last_sql"):
+        return None
+    if not os.path.exists(last_document.get("pdf_path", "")):
+        return None
+    return last_document
+
 def get_db_connection():
     """Establishes a connection to the SQLite database."""
     if not os.path.exists(DATABASE_PATH):
@@ -134,8 +308,15 @@ def get_db_connection():
     return conn
 
 def get_table_schema(table_name="shipments"):
-    """Retrieves the schema (column names and types) for a given table."""
+    """Retrieves the schema (column names and types) for a given table.
+       The result is cached per process and reused until the database file changes.
+    """
     try:
+        db_mtime = os.path.getmtime(DATABASE_PATH) if os.path.exists(DATABASE_PATH) else None
+        cached = _schema_cache.get(table_name)
+        if cached and cached[0] == db_mtime:
+            return cached[1]
+
         conn = get_db_connection()
         cursor = conn.cursor()
         cursor.execute(f"PRAGMA table_info({table_name});")
@@ -156,6 +337,7 @@ def get_table_schema(table_name="shipments"):
         # Log the final schema string being sent to the LLM
         app.logger.info(f"Generated schema string for LLM for table '{table_name}': {final_schema_str}")
         
+        _schema_cache[table_name] = (db_mtime, final_schema_str)
         return final_schema_str
     except Exception as e:
         app.logger.error(f"Error getting table schema for '{table_name}': {e}")
@@ -385,7 +567,7 @@ def generate_sql_with_llm(question, schema, selected_row_data=None, chat_history
         current_sql_to_clean = temp_sql
 
         # Logic for deciding if the final SQL output needs the --PDF_LOOKUP\n prefix
-        is_simple_follow_up = question.strip().lower() in ["yes", "ok", "sure", "tell me more", "what are the values?", "give me the percentages", "i would like to know the values"]
+        is_simple_follow_up = question.strip().lower() in PDF_FOLLOW_UP_PHRASES
         
         assistant_had_successful_pdf_answer_previously = False
         if chat_history and len(chat_history) >= 1:
@@ -527,6 +709,29 @@ def answer_question_from_text_with_llm(original_question, pdf_text, chat_history
         app.logger.error(f"Error calling LLM for QA from text: {e}")
         return f"Error processing document content with LLM: {e}"
 
+def warm_caches():
+    """Fills the schema cache and pre-extracts every PDF under pdf/ into the shared text cache.
+       Called once in the master process before workers are forked (see serve.py), so
+       workers start with a warm schema and never re-extract the same PDFs.
+    """
+    try:
+        get_table_schema()
+    except Exception as e:
+        app.logger.warning(f"Schema cache warm-up skipped: {e}")
+
+    warmed = 0
+    for root, _dirs, files in os.walk(PDF_BASE_DIR):
+        for filename in files:
+            if not filename.lower().endswith('.pdf'):
+                continue
+            try:
+                util_read_pdf_text(os.path.join(root, filename))
+                warmed += 1
+            except Exception as e:
+                app.logger.warning(f"Could not pre-extract PDF '{filename}': {e}")
+    app.logger.info(f"Cache warm-up complete. PDFs in text cache: {warmed}")
+    return warmed
+
 @app.route('/health', methods=['GET'])
 def health_check():
     """
@@ -534,6 +739,38 @@ def health_check():
     """
     return jsonify({"status": "healthy", "message": "LLM Data Service is running!"}), 200
 
+@app.route('/ingest/shipments', methods=['POST'])
+def handle_ingest_shipments():
+    """
+    Incrementally loads a Notion CSV export into the shipments table.
+    Accepts a multipart upload in the 'csvfile' field (same as server.js /api/upload-csv) or a raw text/csv body.
+    Only new and changed rows are written; the response reports how many rows were inserted/updated/unchanged/skipped.
+    """
+    if 'csvfile' in request.files:
+        csv_stream = request.files['csvfile'].stream
+        source_name = request.files['csvfile'].filename
+    elif request.content_length:
+        csv_stream = request.stream
+        source_name = "request body"
+    else:
+        return jsonify({"error": "No CSV provided. Upload it as 'csvfile' or send it as the request body."}), 400
+
+    try:
+        conn = sqlite3.connect(DATABASE_PATH, timeout=30)
+        try:
+            summary = ingest_csv_stream(conn, csv_stream)
+        finally:
+            conn.close()
+        _schema_cache.clear() # The table may have just been created
+        app.logger.info(f"Ingested shipments from {source_name}: {summary}")
+        return jsonify({"status": "success", "source": source_name, **summary}), 200
+    except (ValueError, csv.Error) as e: # Includes a missing shipmentName/oblNo column and UnicodeDecodeError
+        app.logger.error(f"Could not ingest CSV from {source_name}: {e}")
+        return jsonify({"error": "Could not ingest the CSV file.", "details": str(e)}), 400
+    except sqlite3.Error as e:
+        app.logger.error(f"SQLite error while ingesting shipments: {e}")
+        return jsonify({"error": "A database error occurred while ingesting shipments. No rows were changed.", "details": str(e)}), 500
+
 @app.route('/query', methods=['POST'])
 def handle_query():
     """
@@ -542,6 +779,8 @@ def handle_query():
     db_results = None
     natural_answer = "Query processed."
     generated_sql = "# SQL generation not attempted."
+    successful_sql = None # Set when a query or PDF lookup succeeds; remembered for the conversation
+    resolved_document = None
 
     try:
         data = request.get_json()
@@ -550,11 +789,19 @@ def handle_query():
 
         question = data['question']
         selected_row_data = data.get('selected_row_data')
-        chat_history = data.get('chat_history', [])
+        received_chat_history = data.get('chat_history', [])
+        chat_history = received_chat_history
+
+        # Conversation state is kept server-side, so clients only need to send the id back.
+        # A client that still sends chat_history gets the old behaviour for that request.
+        conversation_id = data.get('conversation_id') or str(uuid.uuid4())
+        conversation_state = util_load_conversation(conversation_id)
+        if not chat_history:
+            chat_history = conversation_state["chat_history"]
 
-        app.logger.info(f"Received question: {question}")
+        app.logger.info(f"Received question: {question} (conversation: {conversation_id})")
         if selected_row_data: app.logger.info(f"Received selected_row_data: {selected_row_data}")
-        if chat_history: app.logger.info(f"Received chat_history length: {len(chat_history)}")
+        if chat_history: app.logger.info(f"Using chat_history length: {len(chat_history)}")
         
         table_schema = get_table_schema()
         if not table_schema:
@@ -562,7 +809,12 @@ def handle_query():
 
         pdf_lookup_prefix_marker = "--PDF_LOOKUP"
 
-        if not anthropic_client:
+        followup_document = util_get_followup_document(conversation_state, question)
+        if followup_document:
+            # Reuse the document resolved in the previous turn instead of regenerating the lookup SQL
+            generated_sql = conversation_state["last_sql"]
+            app.logger.info(f"PDF follow-up answered from conversation state. Document: {followup_document['pdf_path']}")
+        elif not anthropic_client:
             app.logger.warning("LLM client not available for SQL generation.")
             natural_answer = "LLM client not available. Cannot generate SQL or process query further."
         else:
@@ -590,8 +842,17 @@ def handle_query():
             generated_sql = generate_sql_with_llm(forced_pdf_question, table_schema, selected_row_data, [])
             app.logger.info(f"SQL from PDF-forced retry: {generated_sql}")
 
+        if followup_document:
+            pdf_text = util_extract_text_from_pdf(followup_document["pdf_path"])
+            if pdf_text:
+                natural_answer = answer_question_from_text_with_llm(question, pdf_text, chat_history)
+                if not natural_answer.startswith(PDF_ANSWER_ERROR_PREFIXES):
+                    successful_sql = generated_sql
+                    resolved_document = followup_document
+            else:
+                natural_answer = "Could not extract text from the identified PDF."
         # Check for the PDF_LOOKUP_MARKER robustly
-        if generated_sql.strip().startswith(pdf_lookup_prefix_marker):
+        elif generated_sql.strip().startswith(pdf_lookup_prefix_marker):
             app.logger.info(f"PDF Lookup detected. SQL for path: {generated_sql}")
             # Remove the prefix and any leading/trailing whitespace from the actual SQL part
             sql_after_prefix = generated_sql.strip()[len(pdf_lookup_prefix_marker):].strip()
@@ -627,11 +888,21 @@ def handle_query():
                                 natural_answer = "Could not determine document type column name from SQL result."
                             else:
                                 app.logger.info(f"Retrieved PDF DB value: '{pdf_path_segment_from_db}', Shipment name: '{shipment_name_for_folder}', DocColumn: '{doc_column_name_used_in_sql}'")
-                                pdf_text = util_extract_text_from_pdf(pdf_path_segment_from_db, shipment_name_for_folder, doc_column_name_used_in_sql)
+                                absolute_pdf_path = util_resolve_pdf_path(pdf_path_segment_from_db, shipment_name_for_folder, doc_column_name_used_in_sql)
+                                pdf_text = util_extract_text_from_pdf(absolute_pdf_path) if absolute_pdf_path else None
                                 if pdf_text:
                                     natural_answer = answer_question_from_text_with_llm(question, pdf_text, chat_history)
                                     db_results = None 
-                                    app.logger.info("Successfully processed PDF text with LLM for an answer.")
+                                    if natural_answer.startswith(PDF_ANSWER_ERROR_PREFIXES):
+                                        app.logger.warning(f"PDF text was extracted but answering failed: {natural_answer}")
+                                    else:
+                                        successful_sql = generated_sql
+                                        resolved_document = {
+                                            "pdf_path": absolute_pdf_path,
+                                            "shipment_name": shipment_name_for_folder,
+                                            "doc_column": doc_column_name_used_in_sql
+                                        }
+                                        app.logger.info("Successfully processed PDF text with LLM for an answer.")
                                 else:
                                     natural_answer = "Could not extract text from the identified PDF."
                     else:
@@ -651,6 +922,7 @@ def handle_query():
             try:
                 db_results = execute_sql_query(generated_sql)
                 natural_answer = "Query executed successfully. Returning data."
+                successful_sql = generated_sql
             except ValueError as ve:
                 app.logger.error(f"Error executing generated SQL: {ve}")
                 natural_answer = f"Error executing the generated SQL query: {ve}"
@@ -658,10 +930,20 @@ def handle_query():
                 app.logger.error(f"Unexpected error during SQL execution: {e}")
                 natural_answer = f"An unexpected error occurred while executing the SQL query."
 
+        new_turns = [{"role": "user", "content": question}]
+        if not natural_answer.startswith(tuple(HISTORY_EXCLUDED_ASSISTANT_PREFIXES)):
+            new_turns.append({"role": "assistant", "content": natural_answer})
+        conversation_state["chat_history"] = list(chat_history) + new_turns
+        # Only this turn's outcome is remembered, so a follow-up can never reach back past a failed or unrelated turn
+        conversation_state["last_sql"] = successful_sql
+        conversation_state["last_document"] = resolved_document
+        util_save_conversation(conversation_id, conversation_state)
+
         response_data = {
+            "conversation_id": conversation_id,
             "received_question": question,
             "received_selected_row": selected_row_data,
-            "received_chat_history": chat_history,
+            "received_chat_history": received_chat_history,
             "table_schema_for_llm": table_schema,
             "sql_query_generated": generated_sql,
             "answer": natural_answer,
@@ -0,0 +1,209 @@
+"""Bulk, incremental loader for the Notion "shipping schedule" CSV export.
+
+Streams the CSV, maps the export's messy headers (" PI VALUE ", "GROSS WEIGHT   ", ...)
+onto the `shipments` columns and upserts by natural key (shipmentName, oblNo) in a
+single transaction. Only the columns present in the CSV are compared and written, and
+rows whose values are unchanged are not written at all.
+
+Used by the /ingest/shipments endpoint in app.py, or from the command line:
+
+    python ingest.py "../shipping schedule 2025 ..._all.csv"
+"""
+import argparse
+import csv
+import io
+import os
+import re
+import sqlite3
+
+# Same location as app.py's DATABASE_PATH (project root, one level up)
+PROJECT_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+DATABASE_PATH = os.path.join(PROJECT_ROOT, 'shipping_data.db')
+
+# Same columns and order as the shipments table created by server.js
+SHIPMENT_COLUMNS = [
+    'shipmentName', 'oblNo', 'status', 'contractNo', 'piNo', 'piValue',
+    'invoiceNo', 'fclsGoods', 'shippingLine', 'etd', 'eta', 'sPrice',
+    'grossWeight', 'contractQuantityMt', 'totalAmount',
+    'provisionalInvoiceValue', 'finalInvoiceBalance',
+    'polZnPercent', 'podZnPercent',
+    'polMoisture', 'podMoisture', 'lmePi', 'lmePol', 'lmePod',
+    'trackingNo', 'dueDate', 'laboratoryReport',
+    'shippingDocsProvisional', 'shippingDocsFinalDocs', 'lastEditedTime'
+]
+NATURAL_KEY_COLUMNS = ('shipmentName', 'oblNo')
+
+SHIPMENTS_TABLE_DDL = (
+    "CREATE TABLE IF NOT EXISTS shipments (id INTEGER PRIMARY KEY AUTOINCREMENT, "
+    + ", ".join(f"{col} TEXT" for col in SHIPMENT_COLUMNS if col != 'lastEditedTime')
+    + ", lastEditedTime TEXT DEFAULT CURRENT_TIMESTAMP)"
+)
+
+# Normalized headers that don't reduce to a column name on their own
+HEADER_ALIASES = {
+    'tracking': 'trackingNo', # "Tracking # "
+    'shippingdocsprovisionalhippingdocsprovisional': 'shippingDocsProvisional', # Typo in the Notion export
+}
+_COLUMNS_BY_NORMALIZED_NAME = {col.lower(): col for col in SHIPMENT_COLUMNS}
+
+BATCH_SIZE = 1000 # Rows per executemany call
+
+
+def normalize_header(header):
+    """Maps a raw CSV header to its shipments column name, or None if the header is unknown.
+       e.g. ' PI VALUE ' -> 'piValue', ' POL ZN%' -> 'polZnPercent', 'GROSS WEIGHT   ' -> 'grossWeight'.
+    """
+    if header is None:
+        return None
+    key = header.lstrip('\ufeff').replace('%', 'percent').lower()
+    key = re.sub(r'[^a-z0-9]', '', key)
+    return HEADER_ALIASES.get(key) or _COLUMNS_BY_NORMALIZED_NAME.get(key)
+
+
+def _natural_key(values, key_columns):
+    return tuple((values.get(col) or '').strip().lower() for col in key_columns)
+
+
+def read_shipment_csv(csv_file):
+    """Reads the CSV header row and returns (columns, rows).
+       `columns` lists the shipments columns the headers map to, in file order; `rows` lazily
+       yields one {column: value} dict per record. Raises ValueError if the file has no
+       shipmentName or oblNo column, since its rows could not be matched to shipments.
+    """
+    reader = csv.reader(csv_file)
+    headers = next(reader, [])
+    column_for_index = [normalize_header(h) for h in headers]
+    columns = list(dict.fromkeys(col for col in column_for_index if col))
+
+    if not any(col in columns for col in NATURAL_KEY_COLUMNS):
+        raise ValueError(
+            f"CSV has no {' or '.join(NATURAL_KEY_COLUMNS)} column. Headers found: {headers}"
+        )
+
+    def iter_rows():
+        for record in reader:
+            if not any(field.strip() for field in record):
+                continue # Skip empty lines
+            row = {}
+            for index, value in enumerate(record):
+                column = column_for_index[index] if index < len(column_for_index) else None
+                if column and column not in row:
+                    row[column] = value.strip()
+            yield row
+
+    return columns, iter_rows()
+
+
+def upsert_shipments(conn, columns, rows):
+    """Inserts new shipments and updates changed ones, keyed by (shipmentName, oblNo).
+       Only the columns a record actually contains are compared and written, so columns absent
+       from the CSV (or missing from a short record) keep their values. An existing row with the
+       same shipmentName and a blank oblNo is updated in place when the OBL number is filled in.
+       Runs in a single transaction on `conn`. Returns a summary dict of row counts.
+    """
+    summary = {"inserted": 0, "updated": 0, "unchanged": 0, "skipped": 0}
+    key_columns = [col for col in NATURAL_KEY_COLUMNS if col in columns]
+    match_blank_obl = len(key_columns) == len(NATURAL_KEY_COLUMNS)
+    column_list = ", ".join(columns)
+
+    # Rows are batched per column set; a full record uses `columns`, a short one a prefix of it
+    pending_inserts = {}
+    pending_updates = {}
+
+    def flush(force=False):
+        for row_columns, params in pending_inserts.items():
+            if params and (force or len(params) >= BATCH_SIZE):
+                conn.executemany(
+                    f"INSERT INTO shipments ({', '.join(row_columns)}) VALUES ({', '.join('?' for _ in row_columns)})",
+                    params
+                )
+                params.clear()
+        for row_columns, params in pending_updates.items():
+            if params and (force or len(params) >= BATCH_SIZE):
+                conn.executemany(
+                    f"UPDATE shipments SET {', '.join(f'{col} = ?' for col in row_columns)} WHERE id = ?",
+                    params
+                )
+                params.clear()
+
+    with conn:
+        conn.execute(SHIPMENTS_TABLE_DDL)
+
+        # Existing rows by natural key: {key: (id, {column: value})}. Duplicate keys keep the newest row.
+        existing = {}
+        # Existing rows whose oblNo is still blank, by shipmentName key: {name_key: full_key}
+        blank_obl_by_name = {}
+        for db_row in conn.execute(f"SELECT id, {column_list} FROM shipments ORDER BY id"):
+            values = dict(zip(columns, db_row[1:]))
+            key = _natural_key(values, key_columns)
+            existing[key] = (db_row[0], values)
+            if match_blank_obl and key[0] and not key[1]:
+                blank_obl_by_name[key[0]] = key
+
+        seen_keys = set()
+
+        for row in rows:
+            key = _natural_key(row, key_columns)
+            if not any(key):
+                summary["skipped"] += 1 # No shipment name or OBL number to match on
+                continue
+            if key in seen_keys:
+                summary["skipped"] += 1 # Duplicate key within the same file; first occurrence wins
+                continue
+            seen_keys.add(key)
+            row_columns = tuple(col for col in columns if col in row)
+
+            matched_key = key
+            if key not in existing and match_blank_obl and key[1] and key[0] in blank_obl_by_name:
+                # OBL number filled in since the last import: claim the row that was stored without one
+                matched_key = blank_obl_by_name.pop(key[0])
+
+            if matched_key in existing:
+                row_id, existing_values = existing.pop(matched_key)
+                if all(row[col] == existing_values.get(col) for col in row_columns):
+                    summary["unchanged"] += 1
+                    continue
+                pending_updates.setdefault(row_columns, []).append(tuple(row[col] for col in row_columns) + (row_id,))
+                summary["updated"] += 1
+            else:
+                pending_inserts.setdefault(row_columns, []).append(tuple(row[col] for col in row_columns))
+                summary["inserted"] += 1
+
+            flush()
+
+        flush(force=True)
+
+    return summary
+
+
+def ingest_csv_stream(conn, binary_stream):
+    """Upserts shipments from a binary CSV stream (e.g. an uploaded file). Handles the UTF-8 BOM in Notion exports.
+       Raises ValueError, before any database write, if the CSV has no natural-key column.
+    """
+    text_stream = io.TextIOWrapper(binary_stream, encoding='utf-8-sig', newline='')
+    try:
+        columns, rows = read_shipment_csv(text_stream)
+        return upsert_shipments(conn, columns, rows)
+    finally:
+        text_stream.detach() # Leave the caller's stream open
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Incrementally load a Notion CSV export into the shipments table.")
+    parser.add_argument("csv_path", help="Path to the Notion CSV export.")
+    parser.add_argument("--db", default=DATABASE_PATH, help="SQLite database to load into.")
+    args = parser.parse_args()
+
+    db_conn = sqlite3.connect(args.db)
+    try:
+        with open(args.csv_path, 'rb') as csv_stream:
+            result = ingest_csv_stream(db_conn, csv_stream)
+    except ValueError as e:
+        parser.exit(1, f"Could not ingest {os.path.basename(args.csv_path)}: {e}\n")
+    finally:
+        db_conn.close()
+    print(f"Ingested {os.path.basename(args.csv_path)}: {result}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+"""Production entry point for the LLM Data Service.
+
+Runs app.py under a preforking WSGI server instead of the Flask dev server:
+
+    python serve.py                          # gunicorn, 4 workers x 2 threads on :5001
+    python serve.py --workers 8 --threads 4
+    python serve.py --server waitress        # single process, threaded (e.g. on Windows)
+
+Every option can also be set through environment variables (LLM_SERVICE_HOST,
+LLM_SERVICE_PORT, LLM_SERVICE_WORKERS, LLM_SERVICE_THREADS, LLM_SERVICE_SERVER).
+
+The app is imported once in the master process and its caches are warmed before
+workers are forked, so every worker inherits the schema cache and the Anthropic
+client, and the extracted PDF text lives in the shared on-disk cache. A graceful
+reload (`kill -HUP <master pid>`) replaces the workers without clearing either.
+With more than one gunicorn worker, conversation state is kept in the shared SQLite
+store, because an in-memory store would be separate in each worker.
+"""
+import argparse
+import os
+
+import app as llm_service
+from app import app, warm_caches
+
+
+def build_arg_parser():
+    parser = argparse.ArgumentParser(description="Run the LLM Data Service with a production WSGI server.")
+    parser.add_argument("--host", default=os.getenv("LLM_SERVICE_HOST", "0.0.0.0"))
+    parser.add_argument("--port", type=int, default=int(os.getenv("LLM_SERVICE_PORT", "5001")))
+    parser.add_argument("--workers", type=int, default=int(os.getenv("LLM_SERVICE_WORKERS", "4")),
+                        help="Number of worker processes (gunicorn only).")
+    parser.add_argument("--threads", type=int, default=int(os.getenv("LLM_SERVICE_THREADS", "2")),
+                        help="Threads per worker process.")
+    parser.add_argument("--server", choices=["gunicorn", "waitress"], default=os.getenv("LLM_SERVICE_SERVER", "gunicorn"))
+    parser.add_argument("--timeout", type=int, default=int(os.getenv("LLM_SERVICE_TIMEOUT", "120")),
+                        help="Worker timeout in seconds; LLM and PDF calls can be slow (gunicorn only).")
+    parser.add_argument("--skip-warmup", action="store_true", help="Do not pre-extract PDFs before serving.")
+    return parser
+
+
+def run_gunicorn(args):
+    from gunicorn.app.base import BaseApplication
+
+    class LLMServiceApplication(BaseApplication):
+        """Serves the already-imported Flask app; with preload_app the master loads it once before forking."""
+
+        def __init__(self, wsgi_app, options):
+            self.wsgi_app = wsgi_app
+            self.options = options
+            super().__init__()
+
+        def load_config(self):
+            for key, value in self.options.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            return self.wsgi_app
+
+    options = {
+        "bind": f"{args.host}:{args.port}",
+        "workers": args.workers,
+        "threads": args.threads,
+        "worker_class": "gthread" if args.threads > 1 else "sync",
+        "timeout": args.timeout,
+        "graceful_timeout": args.timeout,
+        "preload_app": True,
+    }
+    LLMServiceApplication(app, options).run()
+
+
+def run_waitress(args):
+    from waitress import serve
+
+    serve(app, host=args.host, port=args.port, threads=args.threads)
+
+
+def use_shared_conversation_store(args):
+    """Switches the conversation store to SQLite when requests can land on different worker processes."""
+    if args.server == "gunicorn" and args.workers > 1 and llm_service.CONVERSATION_STORE_BACKEND != "sqlite":
+        app.logger.warning(
+            f"Conversation store '{llm_service.CONVERSATION_STORE_BACKEND}' is per-process; "
+            f"using 'sqlite' so conversations are shared across {args.workers} workers."
+        )
+        llm_service.CONVERSATION_STORE_BACKEND = "sqlite"
+
+
+def main():
+    args = build_arg_parser().parse_args()
+    use_shared_conversation_store(args)
+
+    if not args.skip_warmup:
+        warm_caches()
+
+    if args.server == "waitress":
+        run_waitress(args)
+    else:
+        run_gunicorn(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+import io
+import sqlite3
+
+import pytest
+
+from ingest import ingest_csv_stream
+
+HEADER = 'Shipment Name,"OBL No. ","Status "\n'
+
+
+def ingest(conn, body, header=HEADER):
+    return ingest_csv_stream(conn, io.BytesIO((header + body).encode('utf-8')))
+
+
+def shipments(conn):
+    return conn.execute("SELECT shipmentName, oblNo, status FROM shipments ORDER BY id").fetchall()
+
+
+@pytest.fixture
+def conn():
+    connection = sqlite3.connect(':memory:')
+    yield connection
+    connection.close()
+
+
+def test_blank_obl_row_is_updated_when_obl_is_filled_in(conn):
+    ingest(conn, 'A,,Booked\n')
+    summary = ingest(conn, 'A,OBL1,Shipped\n')
+
+    assert summary["updated"] == 1 and summary["inserted"] == 0
+    assert shipments(conn) == [('A', 'OBL1', 'Shipped')]
+
+
+def test_same_name_with_different_obl_numbers_stays_separate(conn):
+    ingest(conn, 'Aims Impex Co/88,OBL1,Done\nAims Impex Co/88,OBL2,Done\n')
+    summary = ingest(conn, 'Aims Impex Co/88,OBL1,Done\nAims Impex Co/88,OBL2,Pending\n')
+
+    assert summary == {"inserted": 0, "updated": 1, "unchanged": 1, "skipped": 0}
+    assert shipments(conn) == [('Aims Impex Co/88', 'OBL1', 'Done'), ('Aims Impex Co/88', 'OBL2', 'Pending')]
+
+
+def test_blank_obl_row_is_claimed_only_once(conn):
+    ingest(conn, 'Aims Impex Co/88,,Booked\n')
+    summary = ingest(conn, 'Aims Impex Co/88,OBL1,Done\nAims Impex Co/88,OBL2,Done\n')
+
+    assert summary["updated"] == 1 and summary["inserted"] == 1
+    assert shipments(conn) == [('Aims Impex Co/88', 'OBL1', 'Done'), ('Aims Impex Co/88', 'OBL2', 'Done')]
+
+
+def test_short_record_keeps_missing_columns(conn):
+    ingest(conn, 'A,OBL1,Shipped\n')
+    summary = ingest(conn, 'A,OBL1\n')
+
+    assert summary["unchanged"] == 1
+    assert shipments(conn) == [('A', 'OBL1', 'Shipped')]
+
+
+def test_columns_missing_from_csv_are_not_overwritten(conn):
+    ingest(conn, 'A,OBL1,Shipped,"$1,000"\n', header=HEADER.rstrip('\n') + '," PI VALUE "\n')
+    ingest(conn, 'A,OBL1,Done\n')
+
+    assert conn.execute("SELECT status, piValue FROM shipments").fetchall() == [('Done', '$1,000')]
+
+
+def test_csv_without_natural_key_column_is_rejected(conn):
+    with pytest.raises(ValueError):
+        ingest(conn, '1,"2\n', header='a,b\n')
+    assert conn.execute("SELECT name FROM sqlite_master WHERE name = 'shipments'").fetchall() == []
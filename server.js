@@ -391,7 +391,7 @@ app.post('/api/upload-csv', upload.single('csvfile'), (req, res) => {
 // API endpoint for LLM Querying - delegates to Python service
 app.post('/api/llm-query', async (req, res) => {
     console.log('POST /api/llm-query request received');
-    const { question, selected_row_data, chat_history } = req.body;
+    const { question, selected_row_data, chat_history, conversation_id } = req.body;
 
     console.log('Forwarding to Python service:', { question, selected_row_data, chat_history: chat_history ? chat_history.map(turn => ({...turn, content: turn.content.slice(0,100) + (turn.content.length > 100 ? '...' : '')})) : [] }); // Log truncated history
 
@@ -415,7 +415,7 @@ app.post('/api/llm-query', async (req, res) => {
 
     const pythonServiceUrl = 'http://localhost:5001/query';
     const response = await axios.post(pythonServiceUrl, 
-        { question, selected_row_data, chat_history: filteredChatHistory }, 
+        { question, selected_row_data, chat_history: filteredChatHistory, conversation_id }, 
         {
             headers: {
                 'Content-Type': 'application/json'